@@ -1,9 +1,27 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+import asyncio
 from bs4 import BeautifulSoup
+import diskcache
+import tiktoken
+import trafilatura
+import hashlib
+import html
+import io
 import json
+import os
+import orjson
+import random
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------------
 # Streamlit Page Config
@@ -16,129 +34,486 @@ st.set_page_config(page_title="Bulk Website AI Insights – Batch Version", layo
 GROQ_KEY = st.secrets.get("GROQ_API_KEY", None)
 API_URL = "https://api.groq.com/openai/v1/chat/completions"
 MODEL = "llama-3.3-70b-versatile"
+TEMPERATURE = 0.1
 
 if not GROQ_KEY:
     st.error("❌ Missing GROQ_API_KEY in Streamlit Secrets.")
 
+@st.cache_resource
+def get_groq_session(api_key):
+    # Every AI call hits the same host, so keep-alive saves a TCP+TLS handshake per row
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=25))
+    return session
+
+GROQ_SESSION = get_groq_session(GROQ_KEY)
+
+# -------------------------
+# Rate Limiting
+# -------------------------
+GROQ_RPM = 30
+MAX_RETRIES = 5
+
+class TokenBucket:
+    """Thread-safe token bucket: only blocks when the request budget is exhausted."""
+
+    def __init__(self, max_rate, time_period=60):
+        self.capacity = max_rate
+        self.tokens = max_rate
+        self.fill_rate = max_rate / time_period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiter():
+    return TokenBucket(GROQ_RPM, time_period=60)
+
+GROQ_LIMITER = get_rate_limiter()
+
+def post_groq(body):
+    for attempt in range(MAX_RETRIES):
+        GROQ_LIMITER.acquire()
+        r = GROQ_SESSION.post(API_URL, json=body, timeout=30)
+        if r.status_code != 429 or attempt == MAX_RETRIES - 1:
+            return r
+
+        # Honour Retry-After, backing off exponentially (with jitter) when it's missing
+        try:
+            retry_after = float(r.headers.get("Retry-After", 0))
+        except ValueError:
+            retry_after = 0
+        time.sleep(max(retry_after, 2 ** attempt) + random.uniform(0, 1))
+
 # -------------------------
 # Helper: Fetch website
 # -------------------------
-def try_fetch(url):
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=12)
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=5)
+MAX_CONNECTIONS = 50
+MAX_CONCURRENT_SCRAPES = 20
+MAX_HTML_BYTES = 131072  # we only keep MAX_CONTENT_TOKENS of text, no need to download whole pages
+MAX_CONTENT_TOKENS = 600  # per-site content budget inside a batched prompt
+MIN_TEXT_CHARS = 500  # below this the extractor probably missed the page; try the next one
+
+_TAG_RE = re.compile(rb"<(script|style|noscript)\b.*?</\1\s*>|<!--.*?-->|<[^>]+>", re.S | re.I)
+
+async def try_fetch_async(session, url):
     try:
-        r = requests.get(url, timeout=12, headers={"User-Agent": "Mozilla/5.0"})
-        if r.status_code == 200:
-            return r.text
+        async with session.get(url, timeout=FETCH_TIMEOUT) as r:
+            if r.status == 200:
+                body = bytearray()
+                async for chunk in r.content.iter_chunked(16384):
+                    body += chunk
+                    if len(body) >= MAX_HTML_BYTES:
+                        break
+                return bytes(body[:MAX_HTML_BYTES])
     except Exception as e:
         st.warning(f"Failed to fetch {url}: {e}")
     return None
 
-def scrape_site(url):
+async def probe_url(session, url):
+    # Cheap HEAD to learn where the site actually lives before downloading a body
+    try:
+        async with session.head(url, allow_redirects=True, timeout=PROBE_TIMEOUT) as r:
+            if r.status < 400:
+                return str(r.url)
+    except Exception:
+        pass
+    return None
+
+@st.cache_resource
+def get_encoder():
+    return tiktoken.get_encoding("cl100k_base")
+
+ENCODER = get_encoder()
+
+def truncate_tokens(text, max_tokens):
+    tokens = ENCODER.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return ENCODER.decode(tokens[:max_tokens])
+
+def extract_text(html_bytes):
+    # Main-content extraction drops nav/footer boilerplate we'd otherwise pay tokens for
+    text = " ".join((trafilatura.extract(html_bytes) or "").split())
+
+    # Regex tag strip is O(bytes); building a DOM is only worth it when that comes up short
+    if len(text) < MIN_TEXT_CHARS:
+        text = _TAG_RE.sub(b" ", html_bytes).decode("utf-8", "ignore")
+        text = " ".join(html.unescape(text).split())
+    if len(text) < MIN_TEXT_CHARS:
+        text = BeautifulSoup(html_bytes, "lxml").get_text(" ", strip=True)
+    return truncate_tokens(text, MAX_CONTENT_TOKENS)
+
+async def scrape_site_async(session, url):
     raw = url.strip()
     if raw.startswith("http"):
         attempts = [raw]
     else:
         base = raw.replace("www.", "")
         attempts = [f"https://{base}", f"http://{base}", f"https://www.{base}", f"http://www.{base}"]
+        resolved = await probe_url(session, attempts[0])
+        if resolved:
+            html_bytes = await try_fetch_async(session, resolved)
+            if html_bytes:
+                return await asyncio.to_thread(extract_text, html_bytes), resolved
+
+            # The https variant answered but its GET didn't: don't pay that timeout twice
+            attempts = [link for link in attempts[1:] if link != resolved]
+
+        # Probe failed (or HEAD isn't supported): fall back to the permutations
 
     for link in attempts:
-        html = try_fetch(link)
-        if html:
-            soup = BeautifulSoup(html, "html.parser")
-            text = soup.get_text(" ", strip=True)
-            return text[:4000], link
+        html_bytes = await try_fetch_async(session, link)
+        if html_bytes:
+            # Parsing and tokenizing is CPU work; keep it off the loop so in-flight fetches don't time out
+            return await asyncio.to_thread(extract_text, html_bytes), link
     return "SCRAPE_ERROR: Unable to fetch site", None
 
+def new_scrape_session():
+    # One session for the whole batch so the connection pool is reused
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    return aiohttp.ClientSession(connector=connector, headers={"User-Agent": "Mozilla/5.0"})
+
+# -------------------------
+# AI Response Cache
+# -------------------------
+CACHE_DIR = ".groq_cache"
+CACHE_TTL = 7 * 86400
+MAX_CACHEABLE_TEMPERATURE = 0.2
+
+@st.cache_resource
+def get_ai_cache():
+    return diskcache.Cache(CACHE_DIR)
+
+AI_CACHE = get_ai_cache()
+
 # -------------------------
 # AI Insights (no summary)
 # -------------------------
-def get_ai_insights(url, scraped_text):
-    prompt = f"""
+# Static instructions go first, in their own system message, so the provider
+# can reuse the cached prefix across every request; per-site data goes last.
+STATIC_SCHEMA_PROMPT = """
 Extract B2B-focused insights only.
 Avoid B2C except HNWI / UHNWI.
 Return ONLY VALID JSON.
 
-JSON format:
-{{
+You will receive several websites, separated by ---.
+Return a JSON object {"results": [...]} with one object per site, in the same order.
+Copy each site's number into "site" and its URL into "website" exactly as given.
+
+JSON format of each object:
+{
+"site": 1,
+"website": "",
 "company_name": "",
 "main_products": [],
 "ideal_customers": [],
 "ideal_audience": [],
 "industry": "",
 "countries_of_operation": []
-}}
-
-Website: {url}
-Content: {scraped_text}
+}
 """
-    body = {"model": MODEL, "messages": [{"role": "user", "content": prompt}], "temperature": 0.1}
-    headers = {"Authorization": f"Bearer {GROQ_KEY}", "Content-Type": "application/json"}
 
+AI_BATCH_SIZE = 5  # sites per request; keeps a full batch well under the model's token limit
+
+def parse_ai_json(raw):
+    # JSON mode should give us a bare object; only scan for braces if it didn't
     try:
-        r = requests.post(API_URL, json=body, headers=headers, timeout=30)
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        pass
+
+    start = raw.find("{")
+    end = raw.rfind("}") + 1
+    if start == -1 or end == 0:
+        return None
+    try:
+        return orjson.loads(raw[start:end])
+    except orjson.JSONDecodeError:
+        return None
+
+def cache_key(url, content):
+    return hashlib.sha256((MODEL + STATIC_SCHEMA_PROMPT + url + content).encode("utf-8")).hexdigest()
+
+def get_ai_insights(sites):
+    """Analyse a list of (url, scraped_text) pairs, returning one dict per site in order."""
+    items = list(sites)  # content is already token-truncated by extract_text
+    results = [None] * len(items)
+
+    # Near-deterministic output for identical content: reuse earlier answers
+    cacheable = TEMPERATURE <= MAX_CACHEABLE_TEMPERATURE
+    keys = [cache_key(url, content) for url, content in items]
+    if cacheable:
+        for i, key in enumerate(keys):
+            results[i] = AI_CACHE.get(key)
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    # Sites that resolved to the same URL (example.com / www.example.com) go out once
+    groups = {}
+    for i in pending:
+        groups.setdefault(normalize_url(items[i][0]), []).append(i)
+    labels = {n: url for n, url in enumerate(groups, start=1)}
+
+    prompt = "\n---\n".join(
+        f"Site {n}: {items[groups[url][0]][0]}\nContent: {items[groups[url][0]][1]}" for n, url in labels.items()
+    )
+    messages = [
+        {"role": "system", "content": STATIC_SCHEMA_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+    body = {
+        "model": MODEL,
+        "messages": messages,
+        "temperature": TEMPERATURE,
+        "response_format": {"type": "json_object"},
+    }
+
+    try:
+        r = post_groq(body)
         resp = r.json()
         if "choices" not in resp:
-            return {"error": resp}
+            return fill_errors(results, {"error": resp})
         raw = resp["choices"][0]["message"]["content"]
 
-        start = raw.find("{")
-        end = raw.rfind("}") + 1
-        if start == -1 or end == -1:
-            return {"error": "Invalid AI JSON"}
+        data = parse_ai_json(raw)
+        if not isinstance(data, dict) or not isinstance(data.get("results"), list):
+            return fill_errors(results, {"error": "Invalid AI JSON"})
+
+        # Match answers by the echoed label and URL, never by position: a miscounted
+        # or skipped entry must not hand one company's insights to another row
+        answers = {}
+        ambiguous = set()
+        for obj in data["results"]:
+            if not isinstance(obj, dict):
+                continue
+            url = normalize_url(str(obj.pop("website", "")))
+            label = parse_label(obj.pop("site", None))
+            if url not in groups or (label is not None and labels.get(label) != url):
+                continue
+            if url in answers:
+                ambiguous.add(url)
 
-        data = json.loads(raw[start:end])
+            # Remove empty fields to save tokens
+            answers[url] = {k: v for k, v in obj.items() if v not in ("", [], None)}
 
-        # Remove empty fields to save tokens
-        cleaned_data = {k: v for k, v in data.items() if v not in ("", [], None)}
-        return cleaned_data
+        for url, cleaned_data in answers.items():
+            if url in ambiguous:
+                continue
+            for i in groups[url]:
+                results[i] = cleaned_data
+                if cacheable and "error" not in cleaned_data:
+                    AI_CACHE.set(keys[i], cleaned_data, expire=CACHE_TTL)
+
+        return fill_errors(results, {"error": "Site missing from AI response"})
     except Exception as e:
-        return {"error": str(e)}
+        return fill_errors(results, {"error": str(e)})
+
+def normalize_url(url):
+    url = url.strip().lower().rstrip("/")
+    url = url.split("://", 1)[-1]
+    return url.removeprefix("www.")
+
+def parse_label(label):
+    # Accept 2, "2" or "Site 2"
+    try:
+        return int(str(label).lower().removeprefix("site").strip())
+    except ValueError:
+        return None
+
+def fill_errors(results, error):
+    return [error if result is None else result for result in results]
+
+# -------------------------
+# Result Persistence
+# -------------------------
+RESULTS_DIR = "out"
+RESULT_FIELDS = [
+    "status", "company_name", "main_products", "ideal_customers",
+    "ideal_audience", "industry", "countries_of_operation", "error",
+]
+RESULT_SCHEMA = pa.schema([("idx", pa.int64())] + [(f, pa.string()) for f in RESULT_FIELDS])
+
+def save_result(results_dir, idx, result):
+    # One fragment per row: progress survives reruns and the final read needs no dedup
+    row = {f: None if result.get(f) is None else str(result[f]) for f in RESULT_FIELDS}
+    table = pa.Table.from_pylist([{"idx": idx, **row}], schema=RESULT_SCHEMA)
+    pq.write_table(table, os.path.join(results_dir, f"{idx}.parquet"))
+
+def load_results(df, results_dir):
+    if not any(name.endswith(".parquet") for name in os.listdir(results_dir)):
+        return df
+    return apply_results(df, pd.read_parquet(results_dir).set_index('idx'))
+
+def apply_results(df, updates):
+    # One aligned update instead of a .loc write per cell
+    new_cols = [c for c in updates.columns if c not in df.columns]
+    df = df.reindex(columns=[*df.columns, *new_cols])
+    df[new_cols] = df[new_cols].astype(object)
+    df.update(updates)
+    return df
 
 # -------------------------
 # Batch Processor
 # -------------------------
-def process_csv(df, website_column, live_box, batch_size=50):
+MAX_AI_WORKERS = 25
+
+def handle_chunk(chunk):
+    # Runs in a worker thread: no Streamlit calls in here
+    insights = get_ai_insights([(final_url, scraped_text) for _, (scraped_text, final_url) in chunk])
+    return [(site, scraped_text, final_url, ai_data) for (site, (scraped_text, final_url)), ai_data in zip(chunk, insights)]
+
+async def stream_batch(sites, on_result):
+    """Scrape sites and analyse them in AI_BATCH_SIZE chunks as soon as they're fetched.
+
+    on_result(site, scraped_text, final_url, ai_data) is called on the script
+    thread in completion order; ai_data is None when the site couldn't be fetched.
+    """
+    loop = asyncio.get_running_loop()
+    sem = asyncio.BoundedSemaphore(MAX_CONCURRENT_SCRAPES)
+
+    with ThreadPoolExecutor(max_workers=MAX_AI_WORKERS) as ex:
+        async with new_scrape_session() as session:
+            async def scrape(site):
+                # The semaphore keeps us from hammering hosts into rate limits
+                async with sem:
+                    return "scraped", (site, await scrape_site_async(session, site))
+
+            async def analyse(chunk):
+                # AI calls are network-bound, so threads overlap them; the rate limiter keeps us within budget
+                return "analysed", await loop.run_in_executor(ex, handle_chunk, chunk)
+
+            # The task set grows as chunks are handed to the AI workers, so wait on it
+            # repeatedly rather than using a fixed as_completed() iterator
+            pending = {asyncio.create_task(scrape(site)) for site in sites}
+            scrapes_left = len(sites)
+            chunk = []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind, result = task.result()
+                    if kind == "analysed":
+                        for row in result:
+                            on_result(*row)
+                        continue
+
+                    scrapes_left -= 1
+                    site, (scraped_text, final_url) = result
+                    if final_url is None:
+                        # Don't pay for an AI call on a site we couldn't fetch
+                        on_result(site, scraped_text, None, None)
+                    else:
+                        chunk.append(result)
+
+                # Overlap AI calls with the scrapes still in flight
+                while len(chunk) >= AI_BATCH_SIZE or (chunk and not scrapes_left):
+                    pending.add(asyncio.create_task(analyse(chunk[:AI_BATCH_SIZE])))
+                    chunk = chunk[AI_BATCH_SIZE:]
+
+def clean_sites(column):
+    return column.fillna("").astype(str).str.strip()
+
+FINISHED_STATUSES = ['done', 'skipped', 'scrape_failed', 'ai_failed']
+FAILED_STATUSES = ['scrape_failed', 'ai_failed']
+
+def process_csv(df, website_column, status_box, results_dir, batch_size=50, retry_failed=False):
+    os.makedirs(results_dir, exist_ok=True)
     if 'status' not in df.columns:
         df['status'] = ''
 
-    to_process = df[df['status'] != 'done'].head(batch_size)
+    # Pick up rows finished by earlier runs on this upload
+    df = load_results(df, results_dir)
+    # Only unprocessed rows, so dead sites and blank websites don't take every batch's slots
+    finished = [status for status in FINISHED_STATUSES if not (retry_failed and status in FAILED_STATUSES)]
+    to_process = df[~df['status'].isin(finished)].head(batch_size)
 
-    for idx, row in to_process.iterrows():
-        site = str(row.get(website_column, "")).strip()
-        if not site:
-            df.loc[idx, 'status'] = 'skipped'
-            continue
+    # Lead lists often repeat a website: scrape and analyse each one once.
+    # The lowercased value only groups rows; we fetch the first original spelling,
+    # since URL paths can be case-sensitive.
+    sites = clean_sites(to_process[website_column])
+    rows_by_site = {}
+    first_seen = {}
+    for idx, site in sites.items():
+        rows_by_site.setdefault(site.lower(), []).append(idx)
+        first_seen.setdefault(site.lower(), site)
+    unique_sites = [site for site in first_seen.values() if site]
 
-        live_box.markdown(f"## 🔍 Processing {idx+1}/{len(df)} – `{site}`")
-        scraped_text, final_url = scrape_site(site)
-        live_box.write(f"🌐 Using URL: {final_url or 'Not Found'}")
-        live_box.write(scraped_text[:500] + "...")
+    def record(site, result):
+        # Broadcast each site's result back to every row that shares it
+        for idx in rows_by_site.get(site.lower(), []):
+            save_result(results_dir, idx, result)
 
-        ai_data = get_ai_insights(final_url or site, scraped_text)
-        live_box.json(ai_data)
+    record("", {'status': 'skipped'})
+    status_box.update(label=f"🌐 Processing {len(unique_sites)} websites...")
 
-        for k, v in ai_data.items():
-            if k not in df.columns:
-                df[k] = None  # Create column if missing
+    done = 0
 
-            # Convert lists/dicts to JSON strings for safe storage
-            if isinstance(v, (list, dict)):
-                v = json.dumps(v, ensure_ascii=False)
-            
-            df.loc[idx, k] = v
+    def on_result(site, scraped_text, final_url, ai_data):
+        # Each finished site appends to the status container as it lands
+        nonlocal done
+        done += 1
+        status_box.update(label=f"🔍 Processed {done}/{len(unique_sites)} websites")
+        if ai_data is None:
+            status_box.markdown(f"❌ `{site}` – Not Found")
+            record(site, {'status': 'scrape_failed'})
+            return
 
-        df.loc[idx, 'status'] = 'done'
-        time.sleep(30)  # Throttle API calls
+        # A failed AI call (429 after retries, timeout, bad JSON) must stay retryable
+        failed = "error" in ai_data
+        status_box.markdown(f"{'⚠️' if failed else '✅'} `{site}` – 🌐 {final_url}")
+        status_box.caption(scraped_text[:500] + "...")
+        status_box.json(ai_data, expanded=False)
 
-    return df
+        # Convert lists/dicts to JSON strings for safe storage
+        row = {k: json.dumps(v, ensure_ascii=False) if isinstance(v, (list, dict)) else v for k, v in ai_data.items()}
+        record(site, {**row, 'status': 'ai_failed' if failed else 'done'})
+
+    asyncio.run(stream_batch(unique_sites, on_result))
+    return load_results(df, results_dir)
 
 # -------------------------
 # Streamlit UI
 # -------------------------
+PREVIEW_ROWS = 200
+
+@st.cache_data
+def load_csv(raw_bytes):
+    # Parsed once per upload instead of on every widget rerun; keep URLs as plain strings.
+    # The default C engine tolerates ragged rows and dedupes repeated headers, which pyarrow doesn't.
+    return pd.read_csv(io.BytesIO(raw_bytes), dtype=str)
+
+def to_csv_bytes(df):
+    buf = io.BytesIO()
+    try:
+        # Arrow's CSV writer is much faster than pandas' and skips the intermediate str
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buf)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Mixed-type columns from the upload can't become Arrow arrays
+        buf = io.BytesIO()
+        df.to_csv(buf, index=False, encoding='utf-8')
+    return buf.getvalue()
+
 st.title("🌍 Bulk Website → AI Insights (Batch 50 per run)")
 file = st.file_uploader("📤 Upload CSV", type=["csv"])
 
 if file:
-    df = pd.read_csv(file)
+    df = load_csv(file.getvalue())
     st.write("### Preview")
     st.dataframe(df.head())
 
@@ -146,16 +521,19 @@ if file:
     auto_col = next((c for c in df.columns if c.lower() in ["website", "url", "domain"]), df.columns[0])
     website_column = st.selectbox("Website Column", df.columns, index=list(df.columns).index(auto_col))
 
-    live_box = st.empty()
+    retry_failed = st.checkbox("🔁 Retry websites that failed (scrape or AI errors)")
 
     if st.button("🚀 Start Processing Batch", use_container_width=True):
-        with st.spinner("Processing batch..."):
-            final_df = process_csv(df, website_column, live_box, batch_size=50)
+        with st.status("Processing batch...", expanded=True) as status_box:
+            results_dir = os.path.join(RESULTS_DIR, hashlib.sha256(file.getvalue()).hexdigest()[:16])
+            final_df = process_csv(df, website_column, status_box, results_dir, batch_size=50, retry_failed=retry_failed)
+            status_box.update(state="complete", expanded=False)
         st.success("🎉 Batch Completed!")
-        st.dataframe(final_df)
+        st.dataframe(final_df.head(PREVIEW_ROWS), use_container_width=True)
+        st.caption(f"Showing {min(PREVIEW_ROWS, len(final_df))}/{len(final_df)} rows")
         st.download_button(
             "📥 Download CSV",
-            data=final_df.to_csv(index=False).encode('utf-8'),
+            data=to_csv_bytes(final_df),
             file_name=f"ai_batch_insights_{int(time.time())}.csv",
             mime="text/csv"
         )